@@ -1,8 +1,9 @@
 import streamlit as st
 import os
+from concurrent.futures import ThreadPoolExecutor
 from modules import database
-from modules.medgemma_model import stream_nutrition_advice, is_model_ready
-from modules.rag_engine import RAGEngine
+from modules.medgemma_model import stream_nutrition_advice, is_model_ready, is_model_warm, get_model
+from modules.rag_engine import RAGEngine, get_rag_engine
 from dotenv import load_dotenv
 
 
@@ -14,9 +15,35 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+
+@st.cache_resource
+def get_rag() -> RAGEngine:
+    """Create the RAG engine once per server process, shared across reruns and sessions."""
+    return get_rag_engine()
+
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    """Background worker pool shared across reruns (model warm-up)."""
+    return ThreadPoolExecutor(max_workers=2)
+
+
+@st.cache_data(ttl=600)
+def _patient_bundle(name: str) -> tuple[str, dict]:
+    """Clinical context string and model patient data for a user, cached across reruns."""
+    patient = database.row_to_dict(database.get_patient(name))
+    patient_data = {
+        'age': patient.get('age', 'Not specified'),
+        'weight_kg': patient.get('weight_kg', 'Not specified'),
+        'medical_history': patient.get('condition', 'General Health'),
+        'dietary_preference': patient.get('dietary_preference', 'Not specified'),
+    }
+    return database.get_patient_context_string(name), patient_data
+
+
 # Ensure Database is Initialized
 database.init_db()
-rag=RAGEngine()
+rag = get_rag()
 
 # Initialize Session State for Login
 if 'user' not in st.session_state:
@@ -31,8 +58,11 @@ with st.sidebar:
     
     # Model Status
     st.subheader("🤖 Model Status")
-    if is_model_ready():
+    if is_model_ready() and is_model_warm():
         st.success("✅ AI Model Ready (Ollama)")
+    elif is_model_ready():
+        st.info("⏳ AI Model Warming Up (Ollama)")
+        st.caption("Loading model weights; the first reply may take a few seconds")
     else:
         st.warning("⚠️ Model Loading... (Using Fallback)")
         st.caption("Make sure Ollama is running: `ollama serve`")
@@ -178,6 +208,7 @@ if menu == "📝 Register Patient":
                     condition, specific_metrics, health_goal
                 )
                 if success:
+                    _patient_bundle.clear()
                     st.success(f"✅ Profile created for **{name}**! Please go to Login.")
                     st.balloons()
                 else:
@@ -206,6 +237,7 @@ elif menu == "🔐 Patient Login":
 elif menu == "💬 AI Consultation":
     if st.session_state['user']:
         user = st.session_state['user']
+        patient_context, patient_data = _patient_bundle(user['name'])
         
         # --- HEADER ---
         st.title(f"👋 Hello, {user['name']}")
@@ -217,7 +249,7 @@ elif menu == "💬 AI Consultation":
             c1.metric("Condition", user['condition'])
             c2.metric("Weight", f"{user['weight_kg']} kg")
             c3.metric("Goal", user['health_goal'])
-            st.caption(f"Medical Context: {database.get_patient_context_string(user['name'])}")
+            st.caption(f"Medical Context: {patient_context}")
 
         st.markdown("### 🥗 AI Nutrition Chat")
         
@@ -252,8 +284,9 @@ elif menu == "💬 AI Consultation":
             # 2. AI Response with Streaming
             with st.chat_message("assistant"):
                 try:
-                    # Get patient context from database
-                    patient_context = database.get_patient_context_string(user['name'])
+                    # Load the model in Ollama while retrieval runs so the first token only waits on prefill
+                    if not is_model_warm():
+                        get_executor().submit(get_model().warm_up)
                     
                     # Retrieve clinical documents from vector store with spinner
                     with st.spinner("🔍 Retrieving clinical guidelines..."):
@@ -269,14 +302,6 @@ elif menu == "💬 AI Consultation":
 RELEVANT CLINICAL GUIDELINES:
 {retrieved_context}"""
                     
-                    # Prepare patient data for the model
-                    patient_data = {
-                        'age': user.get('age', 'Not specified'),
-                        'weight_kg': user.get('weight_kg', 'Not specified'),
-                        'medical_history': user.get('condition', 'General Health'),
-                        'dietary_preference': user.get('dietary_preference', 'Not specified'),
-                    }
-                    
                     # Stream the response from medgemma_model in real-time with larger font
                     st.markdown("<div style='font-size: 16px; line-height: 1.6;'>", unsafe_allow_html=True)
                     response_text = st.write_stream(
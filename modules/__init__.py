@@ -6,9 +6,11 @@ Contains database management, AI model handling, and RAG engine
 from . import database
 from . import medgemma_model
 from . import rag_engine
+from . import vector_stores
 
 __all__ = [
     'database',
     'medgemma_model',
     'rag_engine',
+    'vector_stores',
 ]
@@ -2,7 +2,10 @@ import sqlite3
 import json
 import logging
 import os
-from typing import Dict, Optional, Any
+import threading
+import functools
+import contextlib
+from typing import Callable, Dict, Iterator, Optional, Any, Tuple
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -10,16 +13,66 @@ logger = logging.getLogger(__name__)
 DB_FOLDER = "data"
 DB_NAME = os.path.join(DB_FOLDER, "patients.db")
 
+# Process-wide connection shared by all Streamlit sessions (see _get_conn)
+_conn: Optional[sqlite3.Connection] = None
+_conn_lock = threading.Lock()
 
+
+def _get_conn() -> sqlite3.Connection:
+    """
+    Get the shared database connection, creating it on first use.
+    
+    The connection runs in autocommit mode with WAL journaling so reads on the
+    chat path never reopen the file or wait on a writer.
+    
+    Returns:
+        Shared sqlite3 connection with sqlite3.Row row factory
+    """
+    global _conn
+    if _conn is None:
+        with _conn_lock:
+            if _conn is None:
+                os.makedirs(DB_FOLDER, exist_ok=True)
+                conn = sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None)
+                conn.row_factory = sqlite3.Row
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("PRAGMA temp_store=MEMORY")
+                conn.execute("PRAGMA cache_size=-20000")
+                _conn = conn
+    return _conn
+
+
+def get_connection() -> sqlite3.Connection:
+    """Get the shared connection, e.g. for modules storing their own tables next to patients."""
+    return _get_conn()
+
+
+@contextlib.contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """
+    Run a group of statements on the shared connection as a single transaction.
+    
+    Yields:
+        Shared sqlite3 connection; committed on success, rolled back on error
+    """
+    conn = _get_conn()
+    with _conn_lock:
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+@functools.lru_cache(maxsize=1)
 def init_db() -> None:
     """Initialize database with patients table if not exists."""
-    if not os.path.exists(DB_FOLDER):
-        os.makedirs(DB_FOLDER)
-
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    conn = _get_conn()
     
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS patients (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT UNIQUE NOT NULL,
@@ -34,8 +87,6 @@ def init_db() -> None:
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    conn.commit()
-    conn.close()
     logger.info(f"Database initialized: {DB_NAME}")
 
 def add_patient(
@@ -67,19 +118,16 @@ def add_patient(
         True if patient added successfully, False otherwise
     """
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
         metrics_json = json.dumps(metrics_dict)
         
-        cursor.execute('''
-            INSERT INTO patients 
-            (name, age, gender, weight_kg, height_cm, activity_level, condition, specific_metrics, health_goal)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (name, age, gender, weight, height, activity, condition, metrics_json, goal))
+        with transaction() as conn:
+            conn.execute('''
+                INSERT INTO patients 
+                (name, age, gender, weight_kg, height_cm, activity_level, condition, specific_metrics, health_goal)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (name, age, gender, weight, height, activity, condition, metrics_json, goal))
         
-        conn.commit()
-        conn.close()
+        _format_context.cache_clear()
         logger.info(f"Patient added: {name}")
         return True
         
@@ -100,12 +148,9 @@ def get_patient(name: str) -> Optional[sqlite3.Row]:
     Returns:
         Patient record or None if not found
     """
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM patients WHERE name = ?', (name,))
+    cursor = _get_conn().execute('SELECT * FROM patients WHERE name = ?', (name,))
     patient = cursor.fetchone()
-    conn.close()
+    cursor.close()
     return patient
 
 
@@ -133,30 +178,123 @@ def get_patient_context_string(name: str) -> str:
     Returns:
         Formatted clinical summary string for AI consumption
     """
-    patient = get_patient(name)
+    patient = _fetch_patient_row(name)
     
     if not patient:
         return "PATIENT CONTEXT: General Public (No specific medical history)"
     
-    try:
-        metrics = json.loads(patient['specific_metrics'])
-    except (json.JSONDecodeError, TypeError):
-        metrics = {}
+    return _format_context(
+        patient['name'],
+        patient['created_at'],
+        patient['age'],
+        patient['gender'],
+        patient['weight_kg'],
+        patient['height_cm'],
+        patient['activity_level'],
+        patient['condition'],
+        tuple((key, patient[key]) for key in _METRIC_COLUMNS),
+        patient['health_goal'],
+    )
+
+
+# Disease-specific markers are pulled out of the specific_metrics JSON by
+# SQLite's JSON1 functions, so no JSON is decoded in Python on the chat path.
+_METRIC_COLUMNS = (
+    "hba1c", "medication", "bp_systolic", "bp_diastolic", "hemoglobin",
+    "symptoms", "periods", "weight_gain", "bmi", "target_weight", "metrics_summary",
+)
+
+_CONTEXT_QUERY = '''
+    WITH p AS (
+        SELECT *,
+               CASE WHEN json_valid(specific_metrics) THEN specific_metrics ELSE '{}' END AS m
+        FROM patients WHERE name = ?
+    )
+    SELECT name, created_at, age, gender, weight_kg, height_cm, activity_level, condition, health_goal,
+           json_extract(m, '$.hba1c') AS hba1c,
+           json_extract(m, '$.medication') AS medication,
+           json_extract(m, '$.bp_systolic') AS bp_systolic,
+           json_extract(m, '$.bp_diastolic') AS bp_diastolic,
+           json_extract(m, '$.hemoglobin') AS hemoglobin,
+           COALESCE((SELECT group_concat(value, ', ') FROM json_each(m, '$.symptoms')), '') AS symptoms,
+           json_extract(m, '$.periods') AS periods,
+           json_extract(m, '$.weight_gain') AS weight_gain,
+           json_extract(m, '$.bmi') AS bmi,
+           json_extract(m, '$.target_weight') AS target_weight,
+           -- Values rendered the way str() shows the decoded Python value (True, None, ['a', 1])
+           (SELECT group_concat(t.key || ': ' || CASE t.type
+                       WHEN 'null' THEN 'None'
+                       WHEN 'true' THEN 'True'
+                       WHEN 'false' THEN 'False'
+                       WHEN 'array' THEN '[' || COALESCE((
+                           SELECT group_concat(CASE e.type
+                                      WHEN 'null' THEN 'None'
+                                      WHEN 'true' THEN 'True'
+                                      WHEN 'false' THEN 'False'
+                                      WHEN 'text' THEN quote(e.value)
+                                      ELSE e.value
+                                  END, ', ')
+                           FROM json_each(t.value) AS e
+                       ), '') || ']'
+                       ELSE t.value
+                   END, ', ')
+            FROM json_each(m) AS t) AS metrics_summary
+    FROM p
+'''
+
+
+def _fetch_patient_row(name: str) -> Optional[sqlite3.Row]:
+    """Fetch the patient row used to build the clinical context, with metrics extracted in SQL."""
+    cursor = _get_conn().execute(_CONTEXT_QUERY, (name,))
+    patient = cursor.fetchone()
+    cursor.close()
+    return patient
+
+
+@functools.lru_cache(maxsize=256)
+def _format_context(
+    name: str,
+    created_at: str,
+    age: int,
+    gender: str,
+    weight_kg: float,
+    height_cm: float,
+    activity_level: str,
+    condition: str,
+    metrics: Tuple[Tuple[str, Any], ...],
+    health_goal: str,
+) -> str:
+    """
+    Build the clinical context string from primitive row fields.
     
-    condition = patient['condition']
-    clinical_summary = _format_clinical_summary(condition, metrics)
+    Patient rows are immutable after registration, so (name, created_at)
+    identifies a row version and the cached string never goes stale.
+    """
+    clinical_summary = _format_clinical_summary(condition, dict(metrics))
     
-    context = f"""PATIENT CONTEXT:
-- Name: {patient['name']}
-- Demographics: {patient['age']} years old, {patient['gender']}
-- Body: {patient['weight_kg']}kg, {patient['height_cm']}cm (Activity: {patient['activity_level']})
+    return f"""PATIENT CONTEXT:
+- Name: {name}
+- Demographics: {age} years old, {gender}
+- Body: {weight_kg}kg, {height_cm}cm (Activity: {activity_level})
 
 CLINICAL PROFILE:
 - Condition: {condition}
 - Clinical Markers: {clinical_summary}
-- Goal: {patient['health_goal']}"""
-    
-    return context
+- Goal: {health_goal}"""
+
+
+_SUMMARY_FORMATTERS: Dict[str, Callable[[Dict[str, Any]], str]] = {
+    "Type 2 Diabetes": lambda m: f"HbA1c: {m.get('hba1c')}% | Medication: {m.get('medication')}",
+    "Hypertension": lambda m: f"BP: {m.get('bp_systolic')}/{m.get('bp_diastolic')} mmHg",
+    "Anaemia": lambda m: f"Hemoglobin: {m.get('hemoglobin')} g/dL | Symptoms: {m.get('symptoms')}",
+    "PCOS": lambda m: f"Cycle: {m.get('periods')} | Weight Gain: {'Yes' if m.get('weight_gain') else 'No'}",
+    "Obesity": lambda m: f"BMI: {m.get('bmi')} | Target: {m.get('target_weight')}kg",
+}
+
+
+def _format_generic_metrics(metrics: Dict[str, Any]) -> str:
+    """Format metrics for conditions without a dedicated summary."""
+    return metrics.get('metrics_summary') or "No specific metrics"
 
 
 def _format_clinical_summary(condition: str, metrics: Dict[str, Any]) -> str:
@@ -165,23 +303,10 @@ def _format_clinical_summary(condition: str, metrics: Dict[str, Any]) -> str:
     
     Args:
         condition: Medical condition type
-        metrics: Disease-specific metrics dictionary
+        metrics: Disease-specific metrics extracted by _CONTEXT_QUERY
     
     Returns:
         Formatted clinical summary string
     """
-    summaries = {
-        "Type 2 Diabetes": f"HbA1c: {metrics.get('hba1c')}% | Medication: {metrics.get('medication')}",
-        "Hypertension": f"BP: {metrics.get('bp_systolic')}/{metrics.get('bp_diastolic')} mmHg",
-        "Anaemia": f"Hemoglobin: {metrics.get('hemoglobin')} g/dL | Symptoms: {', '.join(metrics.get('symptoms', []))}",
-        "PCOS": f"Cycle: {metrics.get('periods')} | Weight Gain: {'Yes' if metrics.get('weight_gain') else 'No'}",
-        "Obesity": f"BMI: {metrics.get('bmi')} | Target: {metrics.get('target_weight')}kg",
-    }
-    
-    if condition in summaries:
-        return summaries[condition]
-    
-    return ", ".join([f"{k}: {v}" for k, v in metrics.items()]) if metrics else "No specific metrics"
-
-
-init_db()
\ No newline at end of file
+    fmt = _SUMMARY_FORMATTERS.get(condition)
+    return fmt(metrics) if fmt else _format_generic_metrics(metrics)
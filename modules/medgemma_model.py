@@ -7,16 +7,99 @@ Uses Ollama with MedAIBase/MedGemma1.5:4b model for optimal medical domain perfo
 """
 
 import os
+import asyncio
 import logging
 from typing import Dict, Any, Optional, List
 import warnings
 import json
+import string
+import time
+import threading
+import itertools
 
 from dotenv import load_dotenv
 
+try:
+    import streamlit as st
+except ImportError:
+    st = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    from langchain_core.messages import AIMessageChunk, HumanMessage, SystemMessage
+except ImportError:
+    AIMessageChunk = HumanMessage = SystemMessage = None
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# Streamed output is flushed every STREAM_FLUSH_TOKENS tokens or STREAM_FLUSH_SECONDS
+STREAM_FLUSH_TOKENS = 16
+STREAM_FLUSH_SECONDS = 0.05
+
+
+# --- THE FLEXIBLE SYSTEM PROMPT ---
+# Compiled once at import; only the patient fields are substituted per call.
+# The system message depends only on the patient, so it is byte-identical
+# across turns and Ollama can reuse its KV cache for the whole prefix.
+_SYSTEM_PROMPT = string.Template("""You are Dr. MedGemma, an expert Clinical Nutritionist specializing in Indian diets.
+
+PATIENT $name (${age}y / $gender)
+- Condition: $condition (CRITICAL)
+- Markers: $metrics
+- Goal: $goal
+
+**RESPONSE STRATEGY (ADAPT TO USER):**
+First Mention which information You are using to respond:
+example:Based on the clinical guidelines provided, including the InSH Consensus Guideline for the Hypertension, 2023, and the ICMR Guidelines for Management of Type 2 Diabetes, I can give you specific advice regarding your diet.
+Do not show your thinking process do the thinking in background and repond to the user query with relevent information.
+
+1. **IF USER ASKS ABOUT A SPECIFIC FOOD (e.g., "Can I eat X?"):**
+   - **Verdict**: Start with a clear "Yes", "No", or "Limit".
+   - **Science**: Explain the specific impact on their $condition (e.g., blood sugar spike, sodium load).
+   - **Swap**: Suggest a specific, tasty Indian alternative.
+
+2. **IF USER ASKS FOR A PLAN/ROUTINE/DIET:**
+   - **Structure**: Create a detailed daily schedule (Breakfast, Lunch, Evening Snack, Dinner).
+   - **Foods**: Suggest specific Indian dishes (e.g., Moong Dal Chilla, Ragi Roti, Curd).
+   - **Details**: Mention portion sizes and why this helps their goals.
+
+3. **IF USER ASKS A GENERAL QUESTION:**
+   - Provide a comprehensive, detailed explanation using bullet points.
+   - Be educational and encouraging.
+
+**CRITICAL RULES:**
+- Always address the patient by name.
+- Do NOT be vague. Do NOT just say "Eat healthy." Give examples.
+- Use the provided Clinical Guidelines as the primary source of truth.
+""")
+
+# Per-turn part: retrieved guidelines and the patient's question.
+_REQUEST_PROMPT = string.Template('''CLINICAL GUIDELINES:
+$context
+
+PATIENT REQUEST: "$query"''')
+
+
+def _ollama_client_kwargs() -> Dict[str, Any]:
+    """
+    httpx settings shared by every client that talks to Ollama.
+    
+    Connections are kept alive in a small pool (requests to one local model
+    are serialized anyway), and a connect timeout stops a dead server from
+    hanging the UI; generation itself may legitimately take minutes.
+    """
+    if httpx is None:
+        return {}
+    return {
+        "timeout": httpx.Timeout(300.0, connect=10.0),
+        "limits": httpx.Limits(max_connections=4, max_keepalive_connections=4, keepalive_expiry=300.0),
+    }
+
 
 class MedGemmaModel:
     """Production-grade handler for MedGemma medical language model using Ollama."""
@@ -30,8 +113,14 @@ class MedGemmaModel:
         self.top_k = int(os.getenv('MODEL_TOP_K', '50'))
         self.max_length = int(os.getenv('MODEL_MAX_LENGTH', '3000'))
         self.num_predict = int(os.getenv('NUM_PREDICT', '3000'))
+        self.keep_alive = os.getenv('OLLAMA_KEEP_ALIVE', '24h')
+        self.raw_http = httpx is not None and os.getenv('OLLAMA_RAW_HTTP', 'false').lower() == 'true'
         
         self.llm = None
+        # One httpx.AsyncClient per event loop: its connections are bound to the loop that opened them
+        self._http = {}
+        self._http_lock = threading.Lock()
+        self._warm = False
         
         logger.info(f"MedGemmaModel (Ollama) configuration:")
         logger.info(f"  Model: {self.ollama_model}")
@@ -53,11 +142,15 @@ class MedGemmaModel:
                 top_k=self.top_k,
                 num_predict=self.num_predict,
                 repeat_penalty=1.1,
-                keep_alive="5m",
+                keep_alive=self.keep_alive,
+                client_kwargs=_ollama_client_kwargs(),
             )
             
             logger.info("Ollama ChatOllama initialized successfully")
             
+            # Load the weights in the background so startup isn't blocked
+            threading.Thread(target=self.warm_up, name="ollama-warmup", daemon=True).start()
+            
         except ImportError as e:
             logger.error(f"Required dependency missing: {e}")
             self.llm = None
@@ -75,14 +168,27 @@ class MedGemmaModel:
         """Check if model is ready for inference."""
         return self.llm is not None
     
+    def is_warm(self) -> bool:
+        """Check if a warm-up request has loaded the model into Ollama's memory."""
+        return self._warm
+    
     def _create_nutrition_prompt(
         self,
         patient_data: Dict[str, Any],
         query: str,
         context: Optional[str] = None,
         strict_mode: bool = False,
-    ) -> str:
-        """Create a nutrition advice prompt with patient data and clinical context."""
+    ) -> List:
+        """
+        Create the chat messages for a nutrition advice request.
+        
+        Returns a [SystemMessage, HumanMessage] pair: the system message holds the
+        session-stable persona and patient profile, the human message holds the
+        retrieved guidelines and the query.
+        """
+        if SystemMessage is None:
+            raise ImportError("langchain-core not installed. Install with: pip install langchain-core")
+        
         name = patient_data.get('name', 'Patient')
         age = patient_data.get('age', 'Not specified')
         gender = patient_data.get('gender', 'Not specified')
@@ -95,57 +201,26 @@ class MedGemmaModel:
         if isinstance(raw_metrics, str):
             try:
                 metrics_dict = json.loads(raw_metrics)
-                metrics_str = ", ".join([f"{k}: {v}" for k, v in metrics_dict.items()])
-            except:
+                metrics_str = ", ".join(f"{k}: {v}" for k, v in metrics_dict.items())
+            except (json.JSONDecodeError, TypeError, AttributeError):
                 metrics_str = raw_metrics
         elif isinstance(raw_metrics, dict):
-            metrics_str = ", ".join([f"{k}: {v}" for k, v in raw_metrics.items()])
-
-        # --- THE FLEXIBLE SYSTEM PROMPT ---
-        system_prompt = f"""You are Dr. MedGemma, an expert Clinical Nutritionist specializing in Indian diets.
-
-PATIENT {name} ({age}y / {gender})
-- Condition: {condition} (CRITICAL)
-- Markers: {metrics_str}
-- Goal: {goal}
-
-CLINICAL GUIDELINES:
-{context if context else "Use standard medical knowledge."}
-
-**RESPONSE STRATEGY (ADAPT TO USER):**
-First Mention which information You are using to respond:
-example:Based on the clinical guidelines provided, including the InSH Consensus Guideline for the Hypertension, 2023, and the ICMR Guidelines for Management of Type 2 Diabetes, I can give you specific advice regarding your diet.
-Do not show your thinking process do the thinking in background and repond to the user query with relevent information.
-
-1. **IF USER ASKS ABOUT A SPECIFIC FOOD (e.g., "Can I eat X?"):**
-   - **Verdict**: Start with a clear "Yes", "No", or "Limit".
-   - **Science**: Explain the specific impact on their {condition} (e.g., blood sugar spike, sodium load).
-   - **Swap**: Suggest a specific, tasty Indian alternative.
-
-2. **IF USER ASKS FOR A PLAN/ROUTINE/DIET:**
-   - **Structure**: Create a detailed daily schedule (Breakfast, Lunch, Evening Snack, Dinner).
-   - **Foods**: Suggest specific Indian dishes (e.g., Moong Dal Chilla, Ragi Roti, Curd).
-   - **Details**: Mention portion sizes and why this helps their goals.
-
-3. **IF USER ASKS A GENERAL QUESTION:**
-   - Provide a comprehensive, detailed explanation using bullet points.
-   - Be educational and encouraging.
-
-**CRITICAL RULES:**
-- Always address the patient by name.
-- Do NOT be vague. Do NOT just say "Eat healthy." Give examples.
-- Use the provided Clinical Guidelines as the primary source of truth.
-"""
-
-        full_prompt = f"""<start_of_turn>user
-{system_prompt}
+            metrics_str = ", ".join(f"{k}: {v}" for k, v in raw_metrics.items())
 
-PATIENT REQUEST: "{query}"
-
-ANSWER:<end_of_turn>
-<start_of_turn>model"""
+        system_text = _SYSTEM_PROMPT.substitute(
+            name=name,
+            age=age,
+            gender=gender,
+            condition=condition,
+            metrics=metrics_str,
+            goal=goal,
+        )
+        request_text = _REQUEST_PROMPT.substitute(
+            context=context if context else "Use standard medical knowledge.",
+            query=query,
+        )
         
-        return full_prompt
+        return [SystemMessage(content=system_text), HumanMessage(content=request_text)]
     
     def generate_nutrition_advice(
         self,
@@ -164,7 +239,7 @@ ANSWER:<end_of_turn>
             logger.info(f"Generating advice for {patient_data.get('name', 'Patient')}...")
             
             response = self.llm.invoke(prompt)
-            advice = response.content if hasattr(response, 'content') else str(response)
+            advice = response.content
             
             return advice
             
@@ -189,14 +264,168 @@ ANSWER:<end_of_turn>
             
             logger.info(f"Streaming advice for {patient_data.get('name', 'Patient')}...")
             
-            for chunk in self.llm.stream(prompt):
-                content = chunk.content if hasattr(chunk, 'content') else str(chunk)
-                yield content
+            chunks = iter(self.llm.stream(prompt))
+            first = next(chunks, None)
+            if first is None:
+                return
+            # ChatOllama always streams AIMessageChunk; check once instead of per token
+            assert AIMessageChunk is None or isinstance(first, AIMessageChunk), f"Unexpected stream chunk: {type(first).__name__}"
+            
+            # Coalesce tokens so the UI re-renders per batch rather than per token
+            buf = []
+            last_flush = time.monotonic()
+            for chunk in itertools.chain((first,), chunks):
+                buf.append(chunk.content)
+                if len(buf) >= STREAM_FLUSH_TOKENS or time.monotonic() - last_flush > STREAM_FLUSH_SECONDS:
+                    yield "".join(buf)
+                    buf.clear()
+                    last_flush = time.monotonic()
+            if buf:
+                yield "".join(buf)
+                
+        except Exception as e:
+            logger.error(f"Streaming error: {e}")
+            yield self._fallback_response(patient_data, query, context)
+    
+    async def astream_nutrition_advice(
+        self,
+        patient_data: Dict[str, Any],
+        query: str,
+        context: Optional[str] = None,
+        strict_mode: bool = False,
+    ):
+        """
+        Asynchronously stream nutrition advice.
+        
+        Uses ChatOllama.astream, or a direct /api/generate request when
+        OLLAMA_RAW_HTTP=true (falling back to LangChain if it fails to connect).
+        """
+        try:
+            if not self.is_ready():
+                yield self._fallback_response(patient_data, query, context)
+                return
+            
+            prompt = self._create_nutrition_prompt(patient_data, query, context, strict_mode)
+            
+            logger.info(f"Streaming advice for {patient_data.get('name', 'Patient')} (async)...")
+            
+            buf = []
+            last_flush = time.monotonic()
+            async for content in self._astream_tokens(prompt):
+                buf.append(content)
+                if len(buf) >= STREAM_FLUSH_TOKENS or time.monotonic() - last_flush > STREAM_FLUSH_SECONDS:
+                    yield "".join(buf)
+                    buf.clear()
+                    last_flush = time.monotonic()
+            if buf:
+                yield "".join(buf)
                 
         except Exception as e:
             logger.error(f"Streaming error: {e}")
             yield self._fallback_response(patient_data, query, context)
     
+    async def _astream_tokens(self, messages: List):
+        """Yield raw token text, via direct HTTP when enabled and LangChain otherwise."""
+        if self.raw_http:
+            started = False
+            try:
+                async for text in self.astream_raw(messages[-1].content, system=messages[0].content):
+                    started = True
+                    yield text
+                return
+            except httpx.HTTPError as e:
+                if started:
+                    raise
+                logger.warning(f"Direct Ollama request failed, falling back to LangChain: {e}")
+        
+        chunks = aiter(self.llm.astream(messages))
+        first = await anext(chunks, None)
+        if first is None:
+            return
+        assert AIMessageChunk is None or isinstance(first, AIMessageChunk), f"Unexpected stream chunk: {type(first).__name__}"
+        yield first.content
+        async for chunk in chunks:
+            yield chunk.content
+    
+    def _get_http(self):
+        """Get the running event loop's pooled keep-alive HTTP client for direct Ollama calls."""
+        loop = asyncio.get_running_loop()
+        with self._http_lock:
+            for stale in [l for l in self._http if l.is_closed()]:
+                del self._http[stale]
+            client = self._http.get(loop)
+            if client is None:
+                client = self._http[loop] = httpx.AsyncClient(base_url=self.ollama_base_url, **_ollama_client_kwargs())
+        return client
+    
+    async def astream_raw(self, prompt: str, system: Optional[str] = None):
+        """
+        Stream a completion from Ollama's /api/generate, bypassing LangChain.
+        
+        Each event loop gets its own pooled httpx.AsyncClient, so connections
+        are reused across calls on a long-lived loop and never shared between loops.
+        
+        Args:
+            prompt: User prompt text
+            system: Optional system prompt (applied by the model's chat template)
+        
+        Yields:
+            Response text fragments as Ollama produces them
+        """
+        if httpx is None:
+            raise RuntimeError("httpx not installed. Install with: pip install httpx")
+        
+        payload = {
+            "model": self.ollama_model,
+            "prompt": prompt,
+            "stream": True,
+            "keep_alive": self.keep_alive,
+            "options": {
+                "temperature": self.temperature,
+                "top_p": self.top_p,
+                "top_k": self.top_k,
+                "num_predict": self.num_predict,
+                "repeat_penalty": 1.1,
+            },
+        }
+        if system:
+            payload["system"] = system
+        
+        async with self._get_http().stream("POST", "/api/generate", json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                if "error" in data:
+                    raise RuntimeError(f"Ollama error: {data['error']}")
+                if data.get("response"):
+                    yield data["response"]
+                if data.get("done"):
+                    break
+    
+    def warm_up(self) -> bool:
+        """
+        Force Ollama to load the model into memory with a one-token request.
+        
+        Runs in a background thread at startup, and again while RAG retrieval
+        is in flight if the model is not warm yet, so the real request only
+        pays prefill, not the model load.
+        
+        Returns:
+            True if the warm-up request completed, False otherwise
+        """
+        if not self.is_ready():
+            return False
+        try:
+            self.llm.model_copy(update={"num_predict": 1}).invoke("ok")
+            self._warm = True
+            logger.info("Model warm-up complete")
+            return True
+        except Exception as e:
+            logger.warning(f"Model warm-up failed: {e}")
+            return False
+    
     def _fallback_response(
         self,
         patient_data: Dict[str, Any],
@@ -210,9 +439,20 @@ ANSWER:<end_of_turn>
 # Singleton instance for model management
 _model_instance = None
 
+if st is not None:
+    @st.cache_resource
+    def _cached_model() -> MedGemmaModel:
+        """Create the model once per Streamlit server process, shared across reruns and sessions."""
+        return MedGemmaModel()
+else:
+    _cached_model = None
+
 
 def get_model() -> MedGemmaModel:
     """Get or create the global MedGemmaModel instance (singleton pattern)."""
+    if _cached_model is not None:
+        return _cached_model()
+    
     global _model_instance
     if _model_instance is None:
         _model_instance = MedGemmaModel()
@@ -231,6 +471,12 @@ def is_model_ready() -> bool:
     return model.is_ready()
 
 
+def is_model_warm() -> bool:
+    """Check if the model has been loaded into Ollama's memory."""
+    model = get_model()
+    return model.is_warm()
+
+
 def generate_nutrition_advice(
     patient_data: Dict[str, Any],
     query: str,
@@ -253,6 +499,18 @@ def stream_nutrition_advice(
     yield from model.stream_nutrition_advice(patient_data, query, context, strict_mode)
 
 
+async def astream_nutrition_advice(
+    patient_data: Dict[str, Any],
+    query: str,
+    context: Optional[str] = None,
+    strict_mode: bool = False,
+):
+    """Asynchronously stream nutrition advice token by token."""
+    model = get_model()
+    async for text in model.astream_nutrition_advice(patient_data, query, context, strict_mode):
+        yield text
+
+
 if __name__ == "__main__":
     # Example usage test
     logging.basicConfig(level=logging.INFO)
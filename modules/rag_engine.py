@@ -1,31 +1,312 @@
 """Retrieval-Augmented Generation engine for medical guideline processing."""
 
 import os
+import re
 import logging
-from typing import List, Dict, Any, Optional, Tuple
+import hashlib
+import functools
+import threading
+import time
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 from pathlib import Path
 
+import numpy as np
 from dotenv import load_dotenv
 
+try:
+    from langchain_huggingface import HuggingFaceEmbeddings
+except ImportError:
+    HuggingFaceEmbeddings = None
+
+try:
+    from langchain_community.document_loaders import PyMuPDFLoader
+except ImportError:
+    PyMuPDFLoader = None
+
+try:
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+except ImportError:
+    RecursiveCharacterTextSplitter = None
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+from . import database
+from .vector_stores import ChromaVectorStore, FaissVectorStore, SqliteVecStore, faiss
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
 
+# Default storage location per VECTOR_BACKEND
+_DEFAULT_VECTOR_DB_PATHS = {
+    "chroma": "data/chroma_db",
+    "faiss": "data/faiss_index",
+    "sqlite_vec": database.DB_NAME,
+}
+
+
+# Chunks shorter than this after stripping are not indexed
+MIN_CHUNK_CHARS = 40
+
+# Retrieval results kept per exact (query, max_results) pair
+EXACT_CACHE_SIZE = 512
+
+
+def _load_tokenizer(embedding_model: str):
+    """
+    Load the embedder's tokenizer, resolving the model name like sentence-transformers.
+    
+    A local model directory is read from its tokenizer.json, and a bare hub
+    name such as ``all-MiniLM-L6-v2`` maps to ``sentence-transformers/<name>``.
+    """
+    if os.path.isdir(embedding_model):
+        return Tokenizer.from_file(os.path.join(embedding_model, "tokenizer.json"))
+    if "/" not in embedding_model:
+        embedding_model = f"sentence-transformers/{embedding_model}"
+    return Tokenizer.from_pretrained(embedding_model)
+
+
+@functools.lru_cache(maxsize=4)
+def _get_text_splitter(embedding_model: str, chunk_tokens: int, chunk_overlap_tokens: int):
+    """
+    Build (once per process) a splitter that measures chunks in embedding-model tokens.
+    
+    Chunks are sized to fit the embedder's input window, so nothing is
+    silently truncated at embedding time. Falls back to character counts
+    when the tokenizer cannot be loaded.
+    """
+    separators = ["\n\n", "\n", ". ", "! ", "? ", "; ", ", ", " ", ""]
+    
+    try:
+        if Tokenizer is None:
+            raise ImportError("tokenizers not installed")
+        tokenizer = _load_tokenizer(embedding_model)
+        
+        def token_length(text: str) -> int:
+            return len(tokenizer.encode(text, add_special_tokens=False).ids)
+        
+        return RecursiveCharacterTextSplitter(
+            chunk_size=chunk_tokens,
+            chunk_overlap=chunk_overlap_tokens,
+            length_function=token_length,
+            separators=separators
+        )
+    
+    except Exception as e:
+        logger.warning(f"Token-aware splitting unavailable ({e}); splitting by characters")
+        # ~4 characters per token for English prose
+        return RecursiveCharacterTextSplitter(
+            chunk_size=chunk_tokens * 4,
+            chunk_overlap=chunk_overlap_tokens * 4,
+            separators=separators
+        )
+
+
+def _iter_pdf_chunks(path: str, category: str, splitter_config: Tuple[str, int, int]) -> Iterator:
+    """
+    Stream one PDF page by page, splitting each page as soon as it is read.
+    
+    Args:
+        path: Path to the PDF file
+        category: Disease category for the file
+        splitter_config: (embedding_model, chunk_tokens, chunk_overlap_tokens)
+    
+    Yields:
+        Chunk Documents tagged with source and category metadata
+    """
+    if PyMuPDFLoader is None:
+        raise ImportError("langchain_community not installed. Install with: pip install langchain-community")
+    if RecursiveCharacterTextSplitter is None:
+        raise ImportError("langchain-text-splitters not installed. Install with: pip install langchain-text-splitters")
+    
+    splitter = _get_text_splitter(*splitter_config)
+    name = os.path.basename(path)
+    logger.info(f"Processing PDF: {name}")
+    
+    for page in PyMuPDFLoader(path).lazy_load():
+        page.metadata["source"] = name
+        page.metadata["category"] = category
+        # Citation line built once here instead of on every retrieval
+        page.metadata["header"] = f"[Source: {name} | Category: {category}]"
+        for chunk in splitter.split_documents([page]):
+            # Drop page numbers, running headers and other boilerplate fragments
+            if len(chunk.page_content.strip()) >= MIN_CHUNK_CHARS:
+                yield chunk
+
+
+def _load_pdf_chunks(path: str, category: str, splitter_config: Tuple[str, int, int]) -> List:
+    """List form of _iter_pdf_chunks, module-level so it can run in a ProcessPoolExecutor worker."""
+    return list(_iter_pdf_chunks(path, category, splitter_config))
+
+
+# Filename keyword -> guideline category, in precedence order
+_CATEGORY_KEYWORDS = {
+    "diabetes": "diabetes",
+    "hypertension": "hypertension",
+    "blood_pressure": "hypertension",
+    "anemia": "anaemia",
+    "iron": "anaemia",
+    "pcos": "pcos",
+    "obesity": "obesity",
+    "esi": "obesity",
+    "dietary_guidelines": "general",
+    "icmr": "general",
+    "pregnancy": "pregnancy",
+}
+_CATEGORY_PRIORITY = {keyword: i for i, keyword in enumerate(_CATEGORY_KEYWORDS)}
+_CATEGORY_RE = re.compile(r"(?=(" + "|".join(map(re.escape, _CATEGORY_KEYWORDS)) + r"))")
+
+# Vectors are L2-normalized before they reach the store, so inner product is
+# cosine similarity and every HNSW distance evaluation is a plain dot product.
+# Graph settings suit a guideline corpus of thousands to tens of thousands of
+# chunks: denser links and a wider build beam than Chroma's defaults
+# (M=16, construction_ef=100, search_ef=10) for better recall per hop.
+_CHROMA_COLLECTION_METADATA = {
+    "hnsw:space": "ip",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64,
+}
+
+
+def _l2_normalize(vectors) -> np.ndarray:
+    """Return float32 vectors scaled to unit length (a 1-D input stays 1-D)."""
+    x = np.asarray(vectors, dtype=np.float32)
+    return x / (np.linalg.norm(x, axis=-1, keepdims=True) + 1e-9)
+
+
+def _chunk_id(source: str, text: str) -> str:
+    """
+    Stable ID for a chunk, derived from its source file and content.
+    
+    BLAKE2b is in the standard library, so IDs never change with the set of
+    installed packages (a different hash would re-add every chunk once).
+    """
+    h = hashlib.blake2b(source.encode(), digest_size=16)
+    h.update(b"|")
+    h.update(text.encode())
+    return h.hexdigest()
+
+
+def _format_header(metadata: Dict[str, Any]) -> str:
+    """Citation line for chunks indexed before headers were stored in metadata."""
+    return f"[Source: {metadata.get('source', 'Unknown')} | Category: {metadata.get('category', 'General')}]"
+
+
+class SemanticQueryCache:
+    """
+    Cache of retrieval results keyed by normalized query embedding.
+    
+    A lookup hits when a stored query has cosine similarity >= ``threshold``
+    with the new one, so near-duplicate questions skip the vector search.
+    Entries expire after ``ttl`` seconds; the least recently used entry is
+    evicted once ``maxsize`` is reached.
+    """
+    
+    def __init__(self, maxsize: int = 256, ttl: float = 3600, threshold: float = 0.92):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.clear()
+    
+    def clear(self) -> None:
+        """Drop all cached entries (e.g. after re-indexing)."""
+        # Rows [0, _len) of the preallocated arrays are live; allocated on the first put
+        self._vecs: Optional[np.ndarray] = None
+        self._ks = np.zeros(self.maxsize, dtype=np.int64)
+        self._created = np.zeros(self.maxsize, dtype=np.float64)
+        self._used = np.zeros(self.maxsize, dtype=np.float64)
+        self._vals: List[Optional[Tuple[str, List]]] = [None] * self.maxsize
+        self._len = 0
+    
+    def get(self, q: np.ndarray, max_results: int) -> Optional[Tuple[str, List]]:
+        """
+        Look up a result for a unit-length query vector.
+        
+        Args:
+            q: L2-normalized query embedding
+            max_results: Number of documents the caller asked for
+        
+        Returns:
+            Cached (formatted_context, list_of_documents) or None on miss
+        """
+        with self._lock:
+            n = self._len
+            if n == 0:
+                return None
+            
+            # One matrix-vector product scores every entry; stale or other-k entries never match
+            now = time.monotonic()
+            sims = self._vecs[:n] @ q
+            sims[(self._ks[:n] != max_results) | (now - self._created[:n] > self.ttl)] = -np.inf
+            i = int(sims.argmax())
+            if sims[i] < self.threshold:
+                return None
+            
+            self._used[i] = now
+            return self._vals[i]
+    
+    def put(self, q: np.ndarray, max_results: int, value: Tuple[str, List]) -> None:
+        """Store a result for a unit-length query vector, evicting the LRU entry if full."""
+        with self._lock:
+            if self._vecs is None:
+                self._vecs = np.zeros((self.maxsize, q.shape[0]), dtype=np.float32)
+            
+            if self._len < self.maxsize:
+                i = self._len
+                self._len += 1
+            else:
+                i = int(self._used.argmin())
+            
+            now = time.monotonic()
+            self._vecs[i] = q
+            self._ks[i] = max_results
+            self._created[i] = self._used[i] = now
+            self._vals[i] = value
+
+
 class RAGEngine:
     """Production-grade RAG engine for medical guideline retrieval and processing."""
     
     def __init__(self, load_documents: bool = False):
         """Initialize the RAG engine with vector store and embeddings."""
         self.guidelines_path = "assets/guidelines"
-        self.vector_db_path = os.getenv('VECTOR_DB_PATH', 'data/chroma_db')
+        # Exact FAISS search is the default: the guideline corpus is small and mostly static
+        self.vector_backend = os.getenv('VECTOR_BACKEND', 'faiss').lower()
+        if self.vector_backend == "faiss" and faiss is None:
+            logger.warning("⚠️  faiss not installed (pip install faiss-cpu). Falling back to Chroma")
+            self.vector_backend = "chroma"
+        self.vector_db_path = os.getenv('VECTOR_DB_PATH', _DEFAULT_VECTOR_DB_PATHS.get(self.vector_backend, 'data/faiss_index'))
+        self.embedding_model = os.getenv('EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+        self.embed_batch_size = int(os.getenv('EMBED_BATCH_SIZE', '64'))
+        # all-MiniLM-L6-v2 truncates input beyond 256 word pieces
+        self.chunk_tokens = int(os.getenv('CHUNK_TOKENS', '240'))
+        self.chunk_overlap_tokens = int(os.getenv('CHUNK_OVERLAP_TOKENS', '32'))
         self.vector_store = None
         self.embeddings = None
+        # Per-instance LRU so repeated queries skip the embedding forward pass
+        self._embed_query = functools.lru_cache(maxsize=1024)(self._embed_query_uncached)
+        # Near-duplicate queries reuse an earlier retrieval result
+        self._query_cache = SemanticQueryCache()
+        # Exact repeats (e.g. Streamlit reruns) skip even the query embedding
+        self._exact_cache: "OrderedDict[Tuple[str, int], Tuple[str, List]]" = OrderedDict()
+        self._exact_cache_lock = threading.Lock()
         
         self._initialize_embeddings()
         
         if load_documents:
             logger.info("♻️  Force reload requested. Re-indexing documents...")
             self._initialize_vector_store()
+            if self.vector_store is not None:
+                self.vector_store.clear()
             self.load_pdf_guidelines()
         else:
             if self._vector_store_exists():
@@ -38,53 +319,80 @@ class RAGEngine:
                 self.load_pdf_guidelines()
     
     def _vector_store_exists(self) -> bool:
-        """Check if the vector database directory exists and is not empty."""
-        if not os.path.exists(self.vector_db_path):
-            return False
-        return any(os.scandir(self.vector_db_path))
+        """Check if the configured vector store has been persisted before."""
+        if self.vector_backend == "faiss":
+            return FaissVectorStore.exists(self.vector_db_path)
+        if self.vector_backend == "sqlite_vec":
+            return SqliteVecStore.exists()
+        return ChromaVectorStore.exists(self.vector_db_path)
 
     def _initialize_embeddings(self) -> None:
-        """Initialize Ollama embeddings for document vectorization."""
+        """Initialize sentence-transformers embeddings for document vectorization."""
         try:
-            from langchain_ollama import OllamaEmbeddings
+            if HuggingFaceEmbeddings is None:
+                raise ImportError("langchain_huggingface not installed")
             
-            logger.info("Initializing Ollama embeddings...")
-            self.embeddings = OllamaEmbeddings(model="llama3")
+            logger.info(f"Initializing {self.embedding_model} embeddings...")
+            # Unit-length vectors make cosine similarity a plain dot product
+            self.embeddings = HuggingFaceEmbeddings(
+                model_name=self.embedding_model,
+                encode_kwargs={"batch_size": 64, "normalize_embeddings": True}
+            )
             logger.info("Embeddings initialized successfully")
             
         except ImportError:
-            logger.error("langchain_ollama not installed. Install with: pip install langchain-ollama")
+            logger.error("langchain_huggingface not installed. Install with: pip install langchain-huggingface sentence-transformers")
             self.embeddings = None
         except Exception as e:
             logger.error(f"Embeddings initialization error: {e}")
             self.embeddings = None
     
     def _initialize_vector_store(self) -> None:
-        """Initialize LangChain Chroma vector store."""
+        """Initialize the configured vector store backend (Chroma, FAISS or sqlite-vec)."""
         try:
             if self.embeddings is None:
                 logger.warning("Embeddings not available. Vector store initialization skipped")
                 return
-                
-            from langchain_chroma import Chroma
             
-            logger.info(f"Initializing vector store at: {self.vector_db_path}")
+            logger.info(f"Initializing {self.vector_backend} vector store at: {self.vector_db_path}")
             
-            self.vector_store = Chroma(
-                collection_name="medical_guidelines",
-                embedding_function=self.embeddings,
-                persist_directory=self.vector_db_path
-            )
+            if self.vector_backend == "faiss":
+                self.vector_store = FaissVectorStore(
+                    index_path=self.vector_db_path,
+                    embedding_function=self.embeddings,
+                    index_type=os.getenv('FAISS_INDEX_TYPE', 'flat')
+                )
+            elif self.vector_backend == "sqlite_vec":
+                self.vector_store = SqliteVecStore(embedding_function=self.embeddings)
+            else:
+                self.vector_store = ChromaVectorStore(
+                    collection_name=self._collection_name(),
+                    embedding_function=self.embeddings,
+                    persist_directory=self.vector_db_path,
+                    collection_metadata=_CHROMA_COLLECTION_METADATA
+                )
 
             logger.info("Vector store connection established")
             
-        except ImportError:
-            logger.error("langchain-chroma not installed. Install with: pip install langchain-chroma")
+        except ImportError as e:
+            logger.error(str(e))
             self.vector_store = None
         except Exception as e:
             logger.error(f"Vector store initialization error: {e}")
             self.vector_store = None
     
+    def _collection_name(self) -> str:
+        """
+        Chroma collection per embedding model and index settings.
+        
+        Chroma fixes the metric and graph parameters when a collection is
+        created, so changing either must start a fresh collection.
+        """
+        model_slug = re.sub(r'[^a-z0-9]+', '_', self.embedding_model.split('/')[-1].lower()).strip('_')
+        space = _CHROMA_COLLECTION_METADATA['hnsw:space']
+        links = _CHROMA_COLLECTION_METADATA['hnsw:M']
+        return f"medical_guidelines_{model_slug}_{space}_m{links}"[:63]
+    
     def _check_vector_store_status(self) -> None:
         """Check if vector store has documents and report status."""
         try:
@@ -92,28 +400,37 @@ class RAGEngine:
                 return
             
             # Retrieve collection count safely
-            count = self.vector_store._collection.count()
+            count = self.vector_store.count()
+            if count == 0:
+                # e.g. a new collection after EMBEDDING_MODEL changed
+                logger.warning("⚠️  Vector store is empty. Indexing guidelines...")
+                self.load_pdf_guidelines()
+                return
             logger.info(f"✓ Vector store ready with {count} documents")
                 
         except Exception as e:
             logger.debug(f"Could not check vector store count: {e}")
             logger.info("Vector store initialized")
 
+    def _embed_query_uncached(self, query: str) -> Tuple[float, ...]:
+        """Embed a query string; returned as a tuple so it can be cached."""
+        return tuple(self.embeddings.embed_query(query))
+
     def _get_category_from_filename(self, filename: str) -> str:
         """Assign disease category based on filename."""
-        fname = filename.lower()
-        if "diabetes" in fname: return "diabetes"
-        if "hypertension" in fname or "blood_pressure" in fname: return "hypertension"
-        if "anemia" in fname or "iron" in fname: return "anaemia"
-        if "pcos" in fname: return "pcos"
-        if "obesity" in fname or "esi" in fname: return "obesity"
-        if "dietary_guidelines" in fname or "icmr" in fname: return "general"
-        if "pregnancy" in fname: return "pregnancy"
-        return "general"
+        # Overlapping matches; the keyword listed first in _CATEGORY_KEYWORDS wins
+        matches = [m.group(1) for m in _CATEGORY_RE.finditer(filename.lower())]
+        if not matches:
+            return "general"
+        return _CATEGORY_KEYWORDS[min(matches, key=_CATEGORY_PRIORITY.__getitem__)]
 
     def load_pdf_guidelines(self) -> bool:
         """
         Load and process PDF files into vector store with metadata tagging.
+        
+        Pages are split as they are read and chunks are embedded and stored in
+        batches, so memory stays bounded by the files being parsed rather
+        than the whole corpus.
         """
         os.makedirs(self.guidelines_path, exist_ok=True)
         logger.info(f"Created guidelines directory: {self.guidelines_path}")
@@ -124,70 +441,157 @@ class RAGEngine:
             logger.info(f"No PDFs found in {self.guidelines_path}")
             return False
         
+        if self.vector_store is None:
+            logger.warning("Vector store not available. Documents not stored")
+            return False
+        
         try:
-            from langchain_community.document_loaders import PyMuPDFLoader
+            paths = [str(pdf_file) for pdf_file in pdf_files]
+            categories = [self._get_category_from_filename(pdf_file.name) for pdf_file in pdf_files]
             
-            all_documents = []
+            # Content-addressed IDs: identical chunks collapse, unchanged ones are skipped on store
+            seen = set()
+            added = 0
+            write = None
             
-            for pdf_file in pdf_files:
-                logger.info(f"Processing PDF: {pdf_file.name}")
-                loader = PyMuPDFLoader(str(pdf_file))
-                documents = loader.load()
-                
-                # Add metadata to each document
-                category = self._get_category_from_filename(pdf_file.name)
-                for doc in documents:
-                    doc.metadata["source"] = pdf_file.name
-                    doc.metadata["category"] = category
-                
-                all_documents.extend(documents)
+            logger.info(f"Embedding and adding document chunks in batches of {self.embed_batch_size}...")
+            # One writer thread: batch N is stored while batch N+1 is parsed and embedded
+            with ThreadPoolExecutor(max_workers=1, thread_name_prefix="rag-writer") as writer:
+                for batch in self._iter_batches(paths, categories, seen):
+                    prepared = self._embed_batch(batch)
+                    if write is not None:
+                        added += write.result()
+                    write = writer.submit(self._write_batch, *prepared) if prepared else None
+                if write is not None:
+                    added += write.result()
             
-            if all_documents:
-                self._process_and_store_documents(all_documents)
-                return True
-            else:
+            if not seen:
                 logger.warning("No content extracted from PDFs")
                 return False
+            
+            # An edited chunk was stored under a new hash; drop the versions
+            # these PDFs no longer contain so outdated guidance is not retrieved
+            sources = {os.path.basename(path) for path in paths}
+            stale = sorted(self.vector_store.ids_for_sources(sources) - seen)
+            if stale:
+                self.vector_store.delete(stale)
+                logger.info(f"🧹 Removed {len(stale)} outdated chunks")
+            
+            # Even when nothing was added: persist() also repairs an index that
+            # an interrupted earlier load left without some stored rows
+            self.vector_store.persist()
+            logger.info(f"✓ Documents stored in vector database ({added} new, {len(seen) - added} unchanged, {len(stale)} removed)")
+            
+            self._embed_query.cache_clear()
+            self._query_cache.clear()
+            with self._exact_cache_lock:
+                self._exact_cache.clear()
+            return True
         
-        except ImportError:
-            logger.error("langchain_community not installed. Install with: pip install langchain-community")
+        except ImportError as e:
+            logger.error(str(e))
             return False
         except Exception as e:
             logger.error(f"Error loading PDFs: {e}")
             return False
     
-    def _process_and_store_documents(self, documents: List) -> None:
+    def _iter_chunks(self, paths: List[str], categories: List[str]) -> Iterator:
         """
-        Process documents through text splitting and store in vector database.
+        Yield chunks from every PDF, parsing files in parallel worker processes.
+        
+        At most one file per worker is in flight, so parsed-but-unembedded
+        chunks never pile up while the (slower) embedding step catches up.
         """
-        try:
-            from langchain_text_splitters import RecursiveCharacterTextSplitter
-            
-            logger.info("Starting document processing pipeline...")
-            
-            # Optimized chunking for Medical Text (Context preservation)
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1000,
-                separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""]
+        splitter_config = (self.embedding_model, self.chunk_tokens, self.chunk_overlap_tokens)
+        
+        # PDF parsing is CPU-bound; parse one file per core
+        workers = min(len(paths), os.cpu_count() or 1)
+        if workers == 1:
+            for path, category in zip(paths, categories):
+                yield from _iter_pdf_chunks(path, category, splitter_config)
+            return
+        
+        logger.info(f"Parsing {len(paths)} PDFs across {workers} processes...")
+        tasks = iter(zip(paths, categories))
+        # Spawned, not forked: the server process has live warm-up, torch and tokenizers threads
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as ex:
+            in_flight = deque(
+                ex.submit(_load_pdf_chunks, path, category, splitter_config)
+                for path, category in islice(tasks, workers)
             )
+            while in_flight:
+                chunks = in_flight.popleft().result()
+                for path, category in islice(tasks, 1):
+                    in_flight.append(ex.submit(_load_pdf_chunks, path, category, splitter_config))
+                yield from chunks
+    
+    def _iter_batches(self, paths: List[str], categories: List[str], seen: set) -> Iterator[List[Tuple[str, Any]]]:
+        """
+        Group streamed chunks into embedding batches, dropping repeats.
+        
+        Args:
+            paths: PDF file paths
+            categories: Disease category per path
+            seen: Chunk IDs already yielded; updated in place
+        
+        Yields:
+            Lists of up to embed_batch_size (chunk_id, chunk Document) pairs
+        """
+        pending = []
+        for chunk in self._iter_chunks(paths, categories):
+            cid = _chunk_id(chunk.metadata.get("source", ""), chunk.page_content)
+            if cid in seen:
+                continue
+            seen.add(cid)
+            pending.append((cid, chunk))
+            if len(pending) >= self.embed_batch_size:
+                yield pending
+                pending = []
+        if pending:
+            yield pending
+    
+    def _embed_batch(self, batch: List[Tuple[str, Any]]) -> Optional[Tuple[List[str], np.ndarray, List[str], List[Dict]]]:
+        """
+        Embed the chunks of a batch that the vector store does not have yet.
+        
+        Args:
+            batch: (chunk_id, chunk Document) pairs
+        
+        Returns:
+            (ids, embeddings, texts, metadatas) ready for _write_batch, or None
+            if every chunk is already stored or embedding failed
+        """
+        try:
+            existing = self.vector_store.existing_ids([cid for cid, _ in batch])
+            new = [(cid, chunk) for cid, chunk in batch if cid not in existing]
+            if not new:
+                return None
             
-            logger.info("Splitting documents into chunks...")
-            split_docs = text_splitter.split_documents(documents)
-            logger.info(f"Generated {len(split_docs)} document chunks")
-            
-            if self.vector_store is not None:
-                # Optional: Reset DB if doing a full reload (prevents duplicates)
-                # self.vector_store.delete_collection() 
-                logger.info(f"Adding {len(split_docs)} document chunks to vector store...")
-                self.vector_store.add_documents(split_docs)
-                logger.info("✓ Documents successfully stored in vector database")
-            else:
-                logger.warning("Vector store not available. Documents not stored")
-                
-        except ImportError:
-            logger.error("langchain-text-splitters missing.")
+            texts = [chunk.page_content for _, chunk in new]
+            embeddings = _l2_normalize(self.embeddings.embed_documents(texts))
+            return [cid for cid, _ in new], embeddings, texts, [chunk.metadata for _, chunk in new]
+        
         except Exception as e:
-            logger.error(f"Document processing error: {e}")
+            # Keep indexing; the skipped chunks are picked up by the next load since IDs are content hashes
+            logger.error(f"❌ Failed to embed a batch of {len(batch)} chunks: {e}")
+            return None
+    
+    def _write_batch(self, ids: List[str], embeddings: np.ndarray, texts: List[str], metadatas: List[Dict]) -> int:
+        """
+        Add an embedded batch to the vector store (runs on the writer thread).
+        
+        Returns:
+            Number of chunks added (0 if the write failed)
+        """
+        try:
+            self.vector_store.add(ids=ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+            logger.debug(f"Stored {len(ids)} new chunks")
+            return len(ids)
+        
+        except Exception as e:
+            # Store adds are all-or-nothing, so these IDs stay unknown and the next load retries them
+            logger.error(f"❌ Failed to store a batch of {len(ids)} chunks: {e}")
+            return 0
     
     def retrieve_context(self, query: str, max_results: int = 4) -> Tuple[str, List]:
         """
@@ -204,24 +608,75 @@ class RAGEngine:
             logger.warning("❌ Vector store not available. Initialize embeddings first.")
             return self._get_default_guidance("Vector store unavailable"), []
         
+        key = (query, max_results)
+        with self._exact_cache_lock:
+            cached = self._exact_cache.get(key)
+            if cached is not None:
+                self._exact_cache.move_to_end(key)
+                return cached
+        
         try:
-            # Perform similarity search on query
+            # The query is embedded exactly once; the vector drives cache and search
             logger.debug(f"Searching for: '{query}'")
-            retrieved_docs = self.vector_store.similarity_search(query, k=max_results)
+            query_vector = np.asarray(self._embed_query(query), dtype=np.float32)
+            
+        except Exception as e:
+            logger.error(f"❌ Query embedding error: {e}")
+            return self._get_default_guidance(query), []
+        
+        result = self.retrieve_context_by_vector(query_vector, max_results, query=query)
+        if result[1]:
+            with self._exact_cache_lock:
+                self._exact_cache[key] = result
+                if len(self._exact_cache) > EXACT_CACHE_SIZE:
+                    self._exact_cache.popitem(last=False)
+        return result
+    
+    def retrieve_context_by_vector(
+        self,
+        query_vector,
+        max_results: int = 4,
+        query: str = "this query"
+    ) -> Tuple[str, List]:
+        """
+        Retrieve relevant documents for a query that has already been embedded.
+        
+        Args:
+            query_vector: Query embedding from the engine's embedding model
+            max_results: Maximum number of results to retrieve
+            query: Original query text, used only in log and fallback messages
+            
+        Returns:
+            Tuple of (formatted_context, list_of_documents)
+        """
+        if self.vector_store is None:
+            logger.warning("❌ Vector store not available. Initialize embeddings first.")
+            return self._get_default_guidance("Vector store unavailable"), []
+        
+        try:
+            unit_query = _l2_normalize(query_vector)
+            
+            cached = self._query_cache.get(unit_query, max_results)
+            if cached is not None:
+                logger.info("⚡ Semantic cache hit")
+                return cached
+            
+            retrieved_docs = self.vector_store.similarity_search_by_vector(unit_query, k=max_results)
             
             if not retrieved_docs:
                 logger.warning(f"⚠️  No clinical documents found for query: '{query}'")
-                logger.info("💡 Tip: Ensure PDF guidelines are loaded in data/chroma_db")
+                logger.info(f"💡 Tip: Ensure PDF guidelines are loaded in {self.vector_db_path}")
                 return self._get_default_guidance(query), []
             
             logger.info(f"✓ Retrieved {len(retrieved_docs)} relevant documents")
             
             # Format context with source citation
             serialized_context = "\n\n".join(
-                f"[Source: {doc.metadata.get('source', 'Unknown')} | Category: {doc.metadata.get('category', 'General')}]\n{doc.page_content}"
+                f"{doc.metadata.get('header') or _format_header(doc.metadata)}\n{doc.page_content}"
                 for doc in retrieved_docs
             )
             
+            self._query_cache.put(unit_query, max_results, (serialized_context, retrieved_docs))
             return serialized_context, retrieved_docs
             
         except Exception as e:
@@ -237,6 +692,7 @@ class RAGEngine:
 # --- SINGLETON INSTANCE MANAGEMENT ---
 
 _rag_instance = None
+_rag_lock = threading.Lock()
 
 def get_rag_engine(load_documents: bool = False) -> RAGEngine:
     """
@@ -256,11 +712,19 @@ def get_rag_engine(load_documents: bool = False) -> RAGEngine:
             _rag_instance.load_pdf_guidelines()
         return _rag_instance
     
-    logger.info("✨ Creating new RAGEngine instance...")
-    _rag_instance = RAGEngine(load_documents=load_documents)
+    # Concurrent first calls (one thread per Streamlit session) must not build two engines
+    with _rag_lock:
+        if _rag_instance is None:
+            logger.info("✨ Creating new RAGEngine instance...")
+            _rag_instance = RAGEngine(load_documents=load_documents)
     return _rag_instance
 
 def retrieve_context(query: str, max_results: int = 4) -> Tuple[str, List]:
     """Convenience function to retrieve context."""
     engine = get_rag_engine(load_documents=False)
-    return engine.retrieve_context(query, max_results)
\ No newline at end of file
+    return engine.retrieve_context(query, max_results)
+
+
+if __name__ == "__main__":
+    # python -m modules.rag_engine: rebuild the guideline index from assets/guidelines
+    get_rag_engine(load_documents=True)
@@ -0,0 +1,605 @@
+"""Vector store backends used by the RAG engine for guideline retrieval."""
+
+import os
+import json
+import math
+import sqlite3
+import logging
+import threading
+from typing import List, Dict, Any, Optional, Set
+
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    from langchain_core.documents import Document
+except ImportError:
+    Document = None
+
+try:
+    from langchain_chroma import Chroma
+except ImportError:
+    Chroma = None
+
+from . import database
+
+logger = logging.getLogger(__name__)
+
+
+def _cosine_topk_numpy(q: np.ndarray, embs: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k rows of ``embs`` with the highest dot product with ``q``."""
+    return np.argsort(-(embs @ q))[:k]
+
+
+if njit is not None:
+    # No signature: compiled on the first quantized search, not at import
+    @njit(fastmath=True, cache=True)
+    def _cosine_topk(q, embs, k):
+        """Numba kernel: dot products over unit vectors, then top-k."""
+        n, d = embs.shape
+        scores = np.empty(n, dtype=np.float32)
+        for i in range(n):
+            acc = np.float32(0.0)
+            for j in range(d):
+                acc += q[j] * embs[i, j]
+            scores[i] = acc
+        return np.argsort(-scores)[:k]
+else:
+    _cosine_topk = _cosine_topk_numpy
+
+
+class ChromaVectorStore:
+    """LangChain Chroma collection exposed through the common vector store interface."""
+
+    # Keeps each write transaction (and Chroma's SQLite WAL growth) bounded
+    MAX_ADD_BATCH = 512
+    # Chroma's persistent client always creates this file in the persist directory
+    SQLITE_FILE = "chroma.sqlite3"
+
+    def __init__(
+        self,
+        collection_name: str,
+        embedding_function,
+        persist_directory: str,
+        collection_metadata: Optional[Dict[str, Any]] = None,
+    ):
+        """Open (or create) a persistent Chroma collection, e.g. with HNSW settings in ``collection_metadata``."""
+        if Chroma is None:
+            raise ImportError("langchain-chroma not installed. Install with: pip install langchain-chroma")
+
+        self._store = Chroma(
+            collection_name=collection_name,
+            embedding_function=embedding_function,
+            persist_directory=persist_directory,
+            collection_metadata=collection_metadata
+        )
+        self._collection = self._store._collection
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        """Check if a persisted Chroma database exists (a single stat, no directory scan)."""
+        return os.path.isfile(os.path.join(path, cls.SQLITE_FILE))
+
+    def add(
+        self,
+        ids: List[str],
+        embeddings: List[List[float]],
+        documents: List[str],
+        metadatas: List[Dict[str, Any]],
+    ) -> None:
+        """Add precomputed embeddings with their documents and metadata, at most MAX_ADD_BATCH per call."""
+        for i in range(0, len(ids), self.MAX_ADD_BATCH):
+            j = i + self.MAX_ADD_BATCH
+            self._collection.add(ids=ids[i:j], embeddings=embeddings[i:j], documents=documents[i:j], metadatas=metadatas[i:j])
+
+    def existing_ids(self, ids: List[str]) -> Set[str]:
+        """Return the subset of ``ids`` already stored."""
+        return set(self._collection.get(ids=ids, include=[])["ids"])
+
+    def ids_for_sources(self, sources: Set[str]) -> Set[str]:
+        """Return the IDs of every stored chunk whose ``source`` metadata is in ``sources``."""
+        return set(self._collection.get(where={"source": {"$in": sorted(sources)}}, include=[])["ids"])
+
+    def delete(self, ids: List[str]) -> None:
+        """Delete chunks by ID, at most MAX_ADD_BATCH per call."""
+        for i in range(0, len(ids), self.MAX_ADD_BATCH):
+            self._collection.delete(ids=ids[i:i + self.MAX_ADD_BATCH])
+
+    def clear(self) -> None:
+        """Delete all chunks, recreating the collection with the same settings."""
+        self._store.reset_collection()
+        self._collection = self._store._collection
+
+    def persist(self) -> None:
+        """Chroma writes through on every add; nothing to flush."""
+
+    def count(self) -> int:
+        """Return the number of stored chunks."""
+        return self._collection.count()
+
+    def similarity_search(self, query: str, k: int = 4) -> List:
+        """Return the k documents most similar to the query text."""
+        return self._store.similarity_search(query, k=k)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4) -> List:
+        """Return the k documents most similar to a query embedding."""
+        return self._store.similarity_search_by_vector(embedding, k=k)
+
+
+class FaissVectorStore:
+    """
+    FAISS inner-product index over L2-normalized embeddings (cosine similarity).
+
+    Vectors live in ``index.faiss`` (memory-mapped on load); chunk text, metadata
+    and the original FP32 embedding live in a side SQLite table keyed by the
+    FAISS row id, so the index itself only holds vectors. Every index type
+    stores vectors under their explicit row id (flat and sq8 via
+    IndexIDMap2), and an index that does not cover every stored row is
+    rebuilt from the side table on load.
+
+    Supported index types:
+        flat:   exact IndexFlatIP, best for up to ~100K chunks
+        ivfpq:  IndexIVFPQ with nlist=sqrt(N), trained on persist()
+        ivfsq8: IndexIVFScalarQuantizer with int8 codes (4x smaller than FP32)
+        sq8:    IndexScalarQuantizer, an exhaustive scan over int8 codes (4x
+                smaller than flat, byte-wise SIMD distances), trained on persist()
+
+    Approximate (IVF) indexes fetch the top ``rerank_depth`` candidates and
+    rerank them with the exact FP32 inner product to restore recall.
+    """
+
+    INDEX_FILE = "index.faiss"
+    DOCS_FILE = "docs.sqlite3"
+    DEFAULT_NPROBE = {"ivfpq": 16, "ivfsq8": 8}
+    TRAIN_SAMPLE_PER_LIST = 256
+    # Per-dimension value ranges for sq8 are stable well before this many vectors
+    SQ_TRAIN_SAMPLE = 65536
+
+    def __init__(
+        self,
+        index_path: str,
+        embedding_function,
+        index_type: str = "flat",
+        nprobe: Optional[int] = None,
+        rerank_depth: int = 32,
+    ):
+        """Load an existing index from ``index_path`` or prepare an empty one."""
+        if faiss is None:
+            raise ImportError("faiss not installed. Install with: pip install faiss-cpu")
+
+        self.index_path = index_path
+        self.embedding_function = embedding_function
+        self.index_type = index_type.lower()
+        self.nprobe = nprobe or self.DEFAULT_NPROBE.get(self.index_type, 16)
+        self.rerank_depth = rerank_depth
+        self.index = None
+        self._mmapped = False
+        # In-memory index has changes not yet written to INDEX_FILE
+        self._dirty = False
+        self._lock = threading.RLock()
+
+        os.makedirs(index_path, exist_ok=True)
+        self._docs = sqlite3.connect(os.path.join(index_path, self.DOCS_FILE), check_same_thread=False)
+        self._docs.execute('''
+            CREATE TABLE IF NOT EXISTS chunks (
+                fid INTEGER PRIMARY KEY,
+                id TEXT UNIQUE NOT NULL,
+                document TEXT,
+                metadata TEXT,
+                embedding BLOB
+            )
+        ''')
+        self._docs.commit()
+
+        index_file = os.path.join(index_path, self.INDEX_FILE)
+        if os.path.isfile(index_file):
+            self.index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP)
+            self._mmapped = True
+            self._set_nprobe()
+            logger.info(f"Loaded FAISS index with {self.index.ntotal} vectors")
+
+        n_rows = self.count()
+        if n_rows and not self._covers_rows(n_rows):
+            logger.warning(f"⚠️  FAISS index out of sync with {n_rows} stored chunks. Rebuilding...")
+            self._rebuild()
+            self._write()
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        """Check if a chunk table has been persisted under ``path`` (a single stat)."""
+        return os.path.isfile(os.path.join(path, cls.DOCS_FILE))
+
+    def _set_nprobe(self) -> None:
+        """Apply the configured nprobe when the index is an IVF variant."""
+        try:
+            faiss.extract_index_ivf(self.index).nprobe = self.nprobe
+        except RuntimeError:
+            pass
+
+    def _ensure_writable(self) -> None:
+        """Re-read a memory-mapped index into RAM before mutating it."""
+        if self._mmapped:
+            self.index = faiss.read_index(os.path.join(self.index_path, self.INDEX_FILE))
+            self._mmapped = False
+            self._set_nprobe()
+
+    def _covers_rows(self, n_rows: int) -> bool:
+        """Whether the index holds exactly the stored rows under their row ids."""
+        if self.index is None or self.index.ntotal != n_rows:
+            return False
+        # Indexes written before rows were keyed by id numbered them by position
+        return self._is_ivf() or isinstance(self.index, faiss.IndexIDMap2)
+
+    def _base_index(self):
+        """The index doing the search, i.e. without the IndexIDMap2 wrapper."""
+        if isinstance(self.index, faiss.IndexIDMap2):
+            return faiss.downcast_index(self.index.index)
+        return self.index
+
+    def _build_index(self, dim: int, n_vectors: int):
+        """Create an empty index of the configured type for ``n_vectors`` vectors."""
+        index = self._build_base_index(dim, n_vectors)
+        if isinstance(index, faiss.IndexIVF):
+            return index
+        # Flat and sq8 number rows by position; the map keys them by row id instead
+        return faiss.IndexIDMap2(index)
+
+    def _build_base_index(self, dim: int, n_vectors: int):
+        """Create the underlying index of the configured type."""
+        nlist = max(1, int(math.sqrt(n_vectors)))
+        # k-means needs ~39 training points per centroid (256 centroids per PQ sub-quantizer)
+        min_train = 39 * (256 if self.index_type == "ivfpq" else nlist)
+
+        if self.index_type == "sq8":
+            return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        if self.index_type in ("ivfpq", "ivfsq8"):
+            if n_vectors >= min_train:
+                quantizer = faiss.IndexFlatIP(dim)
+                if self.index_type == "ivfpq":
+                    m = next(m for m in (64, 48, 32, 16, 8, 4, 2, 1) if dim % m == 0)
+                    return faiss.IndexIVFPQ(quantizer, dim, nlist, m, 8, faiss.METRIC_INNER_PRODUCT)
+                return faiss.IndexIVFScalarQuantizer(
+                    quantizer, dim, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+                )
+            logger.info(f"Only {n_vectors} vectors; too few to train {self.index_type}, using exact flat index")
+        return faiss.IndexFlatIP(dim)
+
+    def _training_sample(self, x: np.ndarray) -> np.ndarray:
+        """Pick a random subset of vectors large enough to train the quantizer."""
+        if self._is_ivf():
+            n_sample = min(len(x), faiss.extract_index_ivf(self.index).nlist * self.TRAIN_SAMPLE_PER_LIST)
+        else:
+            n_sample = min(len(x), self.SQ_TRAIN_SAMPLE)
+        if n_sample == len(x):
+            return x
+        rows = np.random.default_rng(0).choice(len(x), size=n_sample, replace=False)
+        return x[rows]
+
+    @staticmethod
+    def _normalize(embeddings) -> np.ndarray:
+        """Return a C-contiguous float32 copy with unit-length rows."""
+        x = np.array(embeddings, dtype=np.float32, ndmin=2, order="C")
+        faiss.normalize_L2(x)
+        return x
+
+    def add(
+        self,
+        ids: List[str],
+        embeddings: List[List[float]],
+        documents: List[str],
+        metadatas: List[Dict[str, Any]],
+    ) -> None:
+        """
+        Add precomputed embeddings with their documents and metadata.
+
+        Index types that need training only record the rows on the first load;
+        the index is trained and filled on ``persist()`` once the corpus is known.
+        A failed add leaves neither rows nor vectors behind, so retrying the
+        same IDs later is safe.
+        """
+        x = self._normalize(embeddings)
+
+        with self._lock:
+            start = self._docs.execute("SELECT COALESCE(MAX(fid) + 1, 0) FROM chunks").fetchone()[0]
+            fids = np.arange(start, start + len(ids), dtype=np.int64)
+
+            if self.index is None and self.index_type == "flat":
+                self.index = self._build_index(x.shape[1], len(ids))
+
+            # All or nothing: rows roll back if the vector add fails, and vectors
+            # are removed again if the commit fails
+            indexed = False
+            try:
+                with self._docs:
+                    self._docs.executemany(
+                        "INSERT INTO chunks (fid, id, document, metadata, embedding) VALUES (?, ?, ?, ?, ?)",
+                        [
+                            (int(fid), cid, doc, json.dumps(meta), vec.tobytes())
+                            for fid, cid, doc, meta, vec in zip(fids, ids, documents, metadatas, x)
+                        ]
+                    )
+                    if self.index is not None:
+                        self._ensure_writable()
+                        self.index.add_with_ids(x, fids)
+                        self._dirty = indexed = True
+            except Exception:
+                if indexed:
+                    self.index.remove_ids(fids)
+                raise
+
+    def _is_ivf(self) -> bool:
+        """Whether the current index is an IVF variant (supports explicit ids and nprobe)."""
+        return isinstance(self.index, faiss.IndexIVF)
+
+    def existing_ids(self, ids: List[str]) -> Set[str]:
+        """Return the subset of ``ids`` already stored."""
+        placeholders = ",".join("?" * len(ids))
+        rows = self._docs.execute(f"SELECT id FROM chunks WHERE id IN ({placeholders})", ids).fetchall()
+        return {cid for (cid,) in rows}
+
+    def ids_for_sources(self, sources: Set[str]) -> Set[str]:
+        """Return the IDs of every stored chunk whose ``source`` metadata is in ``sources``."""
+        placeholders = ",".join("?" * len(sources))
+        rows = self._docs.execute(
+            f"SELECT id FROM chunks WHERE json_extract(metadata, '$.source') IN ({placeholders})", sorted(sources)
+        ).fetchall()
+        return {cid for (cid,) in rows}
+
+    def delete(self, ids: List[str]) -> None:
+        """
+        Delete chunks by ID from the side table and the index.
+
+        If the commit fails after the vectors were removed, the index no longer
+        covers the stored rows and is rebuilt from them on ``persist()``.
+        """
+        if not ids:
+            return
+        placeholders = ",".join("?" * len(ids))
+        with self._lock:
+            with self._docs:
+                fids = [fid for (fid,) in self._docs.execute(
+                    f"SELECT fid FROM chunks WHERE id IN ({placeholders})", ids
+                ).fetchall()]
+                self._docs.execute(f"DELETE FROM chunks WHERE id IN ({placeholders})", ids)
+                if self.index is not None and fids:
+                    self._ensure_writable()
+                    self.index.remove_ids(np.array(fids, dtype=np.int64))
+                    self._dirty = True
+
+    def clear(self) -> None:
+        """Delete all chunks and the index file."""
+        with self._lock:
+            with self._docs:
+                self._docs.execute("DELETE FROM chunks")
+            self.index = None
+            self._mmapped = False
+            self._dirty = False
+            index_file = os.path.join(self.index_path, self.INDEX_FILE)
+            if os.path.isfile(index_file):
+                os.remove(index_file)
+
+    def persist(self) -> None:
+        """
+        Make the index cover every stored row and write it to disk if it changed.
+
+        Safe to call after a load that added nothing: an index left behind by
+        an interrupted ingest is rebuilt from the side table here.
+        """
+        with self._lock:
+            n_rows = self.count()
+            if n_rows == 0:
+                return
+
+            if not self._covers_rows(n_rows):
+                self._rebuild()
+
+            if self._dirty or not os.path.isfile(os.path.join(self.index_path, self.INDEX_FILE)):
+                self._write()
+
+    def _rebuild(self) -> None:
+        """Build, train and fill a fresh index from every row in the side table."""
+        fids, x = self._load_embeddings()
+        self.index = self._build_index(x.shape[1], len(fids))
+        self._mmapped = False
+        if not self.index.is_trained:
+            logger.info(f"Training {self.index_type} index on {len(fids)} vectors...")
+            self.index.train(self._training_sample(x))
+            self._set_nprobe()
+        self.index.add_with_ids(x, fids)
+        self._dirty = True
+
+    def _write(self) -> None:
+        """Atomically replace the index file with the in-memory index."""
+        index_file = os.path.join(self.index_path, self.INDEX_FILE)
+        tmp_file = index_file + ".tmp"
+        faiss.write_index(self.index, tmp_file)
+        os.replace(tmp_file, index_file)
+        self._dirty = False
+        logger.info(f"FAISS index saved with {self.index.ntotal} vectors")
+
+    def _load_embeddings(self):
+        """Read all stored FP32 embeddings ordered by FAISS row id."""
+        rows = self._docs.execute("SELECT fid, embedding FROM chunks ORDER BY fid").fetchall()
+        fids = np.fromiter((fid for fid, _ in rows), dtype=np.int64, count=len(rows))
+        x = np.vstack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows])
+        return fids, x
+
+    def count(self) -> int:
+        """Return the number of stored chunks."""
+        return self._docs.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def similarity_search(self, query: str, k: int = 4) -> List:
+        """Return the k documents most similar to the query text."""
+        return self.similarity_search_by_vector(self.embedding_function.embed_query(query), k=k)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4) -> List:
+        """Return the k documents most similar to a query embedding."""
+        q = self._normalize(embedding)
+        with self._lock:
+            if self.index is None or self.index.ntotal == 0:
+                return []
+            exact = isinstance(self._base_index(), faiss.IndexFlat)
+            _, ids = self.index.search(q, k if exact else max(k, self.rerank_depth))
+
+        fids = [int(i) for i in ids[0] if i >= 0]
+        if not fids:
+            return []
+
+        placeholders = ",".join("?" * len(fids))
+        rows = self._docs.execute(
+            f"SELECT fid, document, metadata, embedding FROM chunks WHERE fid IN ({placeholders})", fids
+        ).fetchall()
+        by_fid = {fid: (doc, meta, blob) for fid, doc, meta, blob in rows}
+        fids = [fid for fid in fids if fid in by_fid]
+
+        if not exact:
+            # Rerank quantized candidates with the exact FP32 inner product
+            vecs = np.ascontiguousarray(
+                np.vstack([np.frombuffer(by_fid[fid][2], dtype=np.float32) for fid in fids])
+            )
+            order = _cosine_topk(q[0], vecs, int(k))
+            fids = [fids[i] for i in order]
+
+        return [
+            Document(page_content=by_fid[fid][0], metadata=json.loads(by_fid[fid][1]))
+            for fid in fids
+        ]
+
+
+class SqliteVecStore:
+    """
+    sqlite-vec ``vec0`` virtual table stored next to the patients table.
+
+    Shares the application's SQLite connection, so retrieval needs no separate
+    vector process and new chunks are cheap incremental inserts. Chunks are
+    searched by cosine distance; text and metadata are auxiliary columns.
+    """
+
+    TABLE = "rag_chunks"
+
+    def __init__(self, embedding_function):
+        """Load the sqlite-vec extension into the shared connection."""
+        self.embedding_function = embedding_function
+        # Reads go through this connection, writes through database.transaction() on the same one
+        self._conn = database.get_connection()
+        self._load_extension()
+
+    def _load_extension(self) -> None:
+        """Load sqlite-vec from the Python package, or a system ``vec0`` library."""
+        if not hasattr(self._conn, "enable_load_extension"):
+            raise RuntimeError(
+                "This Python's sqlite3 module was built without extension loading; "
+                "sqlite-vec needs a Python compiled with loadable SQLite extensions"
+            )
+        try:
+            self._conn.enable_load_extension(True)
+            try:
+                import sqlite_vec
+                sqlite_vec.load(self._conn)
+            except ImportError:
+                self._conn.load_extension("vec0")
+            self._conn.enable_load_extension(False)
+        except sqlite3.OperationalError:
+            raise ImportError("sqlite-vec not available. Install with: pip install sqlite-vec")
+
+    @classmethod
+    def exists(cls, path: Optional[str] = None) -> bool:
+        """Check if the chunk table has been created in the shared database."""
+        row = database.get_connection().execute(
+            "SELECT 1 FROM sqlite_master WHERE name = ?", (cls.TABLE,)
+        ).fetchone()
+        return row is not None
+
+    def add(
+        self,
+        ids: List[str],
+        embeddings: List[List[float]],
+        documents: List[str],
+        metadatas: List[Dict[str, Any]],
+    ) -> None:
+        """Add precomputed embeddings with their documents and metadata."""
+        x = np.asarray(embeddings, dtype=np.float32)
+
+        with database.transaction() as conn:
+            conn.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS {self.TABLE} USING vec0(
+                    chunk_id TEXT PRIMARY KEY,
+                    embedding float[{x.shape[1]}] distance_metric=cosine,
+                    +document TEXT,
+                    +metadata TEXT
+                )
+            ''')
+            conn.executemany(
+                f"INSERT INTO {self.TABLE} (chunk_id, embedding, document, metadata) VALUES (?, ?, ?, ?)",
+                [
+                    (cid, vec.tobytes(), doc, json.dumps(meta))
+                    for cid, vec, doc, meta in zip(ids, x, documents, metadatas)
+                ]
+            )
+
+    def existing_ids(self, ids: List[str]) -> Set[str]:
+        """Return the subset of ``ids`` already stored."""
+        if not self.exists():
+            return set()
+        placeholders = ",".join("?" * len(ids))
+        rows = self._conn.execute(
+            f"SELECT chunk_id FROM {self.TABLE} WHERE chunk_id IN ({placeholders})", ids
+        ).fetchall()
+        return {cid for (cid,) in rows}
+
+    def ids_for_sources(self, sources: Set[str]) -> Set[str]:
+        """Return the IDs of every stored chunk whose ``source`` metadata is in ``sources``."""
+        if not self.exists():
+            return set()
+        placeholders = ",".join("?" * len(sources))
+        rows = self._conn.execute(
+            f"SELECT chunk_id FROM {self.TABLE} WHERE json_extract(metadata, '$.source') IN ({placeholders})",
+            sorted(sources)
+        ).fetchall()
+        return {cid for (cid,) in rows}
+
+    def delete(self, ids: List[str]) -> None:
+        """Delete chunks by ID."""
+        if not ids or not self.exists():
+            return
+        with database.transaction() as conn:
+            conn.executemany(f"DELETE FROM {self.TABLE} WHERE chunk_id = ?", [(cid,) for cid in ids])
+
+    def clear(self) -> None:
+        """Drop the chunk table; it is recreated with the right dimension on the next add."""
+        with database.transaction() as conn:
+            conn.execute(f"DROP TABLE IF EXISTS {self.TABLE}")
+
+    def persist(self) -> None:
+        """Rows are committed on add; nothing to flush."""
+
+    def count(self) -> int:
+        """Return the number of stored chunks."""
+        if not self.exists():
+            return 0
+        return self._conn.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+
+    def similarity_search(self, query: str, k: int = 4) -> List:
+        """Return the k documents most similar to the query text."""
+        return self.similarity_search_by_vector(self.embedding_function.embed_query(query), k=k)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4) -> List:
+        """Return the k documents most similar to a query embedding."""
+        if not self.exists():
+            return []
+
+        rows = self._conn.execute(
+            f"SELECT document, metadata FROM {self.TABLE} WHERE embedding MATCH ? AND k = ? ORDER BY distance",
+            (np.asarray(embedding, dtype=np.float32).tobytes(), k)
+        ).fetchall()
+
+        return [Document(page_content=doc, metadata=json.loads(meta)) for doc, meta in rows]
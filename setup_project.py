@@ -33,7 +33,8 @@ LANGSMITH_API_KEY=your_langsmith_api_key_here
 
 # Database Configuration
 DATABASE_PATH=data/patients.db
-VECTOR_DB_PATH=data/chroma_db
+VECTOR_BACKEND=faiss
+VECTOR_DB_PATH=data/faiss_index
 
 # Model Configuration
 MODEL_NAME=medgemma-7b